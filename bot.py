@@ -1,17 +1,20 @@
 import logging
-import random
-import string
+import secrets
 import yaml
 import base64
 import os
 import uuid
 import time
 import json
+import sqlite3
+import asyncio
+import operator
+import threading
+import importlib.util
 from pathlib import Path
-from datetime import datetime, timedelta
 from urllib.parse import urlencode, quote
-from typing import Optional, List, Any
-import requests
+from typing import Optional, List, Any, NamedTuple
+import httpx
 
 # Import from python-telegram-bot library
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
@@ -24,11 +27,31 @@ from telegram.error import Forbidden, BadRequest
 # Import for translation
 from translate import Translator
 
+# Prefer the LibYAML-backed C loader, falling back to pure Python
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Prefer orjson for JSON (de)serialization, falling back to the stdlib
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj: Any) -> str: return orjson.dumps(obj).decode()
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+    def json_dumps(obj: Any) -> str: return json.dumps(obj, separators=(",", ":"))
+
+# HTTP/2 needs the optional h2 package (httpx[http2]); fall back to HTTP/1.1 without it
+HTTP2 = importlib.util.find_spec("h2") is not None
+
 # --- Configuration & Constants ---
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = os.getenv("ADMIN")
 CONFIG_FILE = Path("database.yaml")
-USER_DB_FILE = Path("users.yaml")
+USER_DB_FILE = Path("users.db")
+LEGACY_USER_DB_FILE = Path("users.yaml")
 
 # Conversation states
 SELECT_USER, SELECT_DURATION, SELECT_QUOTA = range(3)
@@ -40,6 +63,18 @@ GET_BROADCAST_MESSAGE = range(7, 8)
 # Constants
 GB_TO_BYTES = 1024**3
 DAYS_TO_MS = 24 * 60 * 60 * 1000
+INBOUNDS_CACHE_TTL = 10  # seconds a panel's inbound list is reused before refetching
+PANEL_TIMEOUT = 30  # seconds before a panel request is given up on
+SESSION_REFRESH_INTERVAL = 60  # seconds between background checks of the panel sessions
+SESSION_REFRESH_MARGIN = 120  # seconds before a session cookie expires that it gets renewed
+USER_PAGE_SIZE = 48  # users per admin picker page (16 rows of 3); Telegram caps an inline keyboard at 100 buttons
+
+class ServerCtx(NamedTuple):
+    """A configured panel from config['db'], resolved once per config load."""
+    name: str
+    address: str
+    panel_path: str
+    inbound_ids: list
 
 # --- Logging Setup ---
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
@@ -51,98 +86,155 @@ logger = logging.getLogger(__name__)
 # ==============================================================================
 
 class XUIApi:
-    """A wrapper for the 3X-UI panel API."""
+    """An async wrapper for the 3X-UI panel API."""
     def __init__(self, address: str, panel_path: str, username: str, password: str):
         self.base_url = f"{address.rstrip('/')}{panel_path}"
-        self.session = requests.Session()
-        self.session.headers.update({'Accept': 'application/json'})
-        self.logged_in = self._login(username, password)
-
-    def _login(self, username, password):
+        self._login_url = f"{self.base_url}login"
+        self._inbounds_url = f"{self.base_url}panel/api/inbounds/"
+        self._list_url = f"{self._inbounds_url}list"
+        self._add_client_url = f"{self._inbounds_url}addClient"
+        # One long-lived client per panel: keeps the session cookie and (over HTTP/2) multiplexes concurrent calls on one connection
+        self.client = httpx.AsyncClient(
+            headers={'Accept': 'application/json'}, timeout=PANEL_TIMEOUT,
+            # retries only cover failed connects, so they are safe for non-idempotent POSTs too
+            transport=httpx.AsyncHTTPTransport(verify=False, http2=HTTP2, retries=2,
+                                               limits=httpx.Limits(max_keepalive_connections=16, max_connections=32))
+        )
+        self.username, self.password = username, password
+        self.logged_in = False
+        self._login_lock = asyncio.Lock()
+        # Successful logins so far; a request rejected before the latest one just retries instead of logging in again
+        self._logins = 0
+        # Epoch seconds the session cookie expires at, or None if the panel set no expiry
+        self.session_expires: Optional[float] = None
+        # (monotonic time, inbounds) from the last list call; _writes lets a fetch that raced a write skip storing
+        self._inbounds_snapshot: Optional[tuple] = None
+        self._writes = 0
+        # {inbound id: (raw settings JSON, {email: client})}; an entry stays valid for as long as the panel returns the same string
+        self._clients_index: dict = {}
+
+    def _invalidate_inbounds(self) -> None:
+        self._writes += 1
+        self._inbounds_snapshot = None
+
+    def clients_by_email(self, inbound: dict) -> dict:
+        """Returns an inbound's clients keyed by email, parsing its settings only when they changed; don't mutate it."""
+        raw_settings = inbound.get("settings", "{}")
+        entry = self._clients_index.get(inbound.get('id'))
+        if entry and entry[0] == raw_settings: return entry[1]
+        index = {c.get('email'): c for c in json_loads(raw_settings).get("clients", [])}
+        self._clients_index[inbound.get('id')] = (raw_settings, index)
+        return index
+
+    async def ensure_login(self) -> bool:
+        """Logs in unless this client already holds a session; concurrent callers share one login."""
+        async with self._login_lock:
+            if not self.logged_in: self.logged_in = await self._login()
+        return self.logged_in
+
+    async def refresh_session(self) -> None:
+        """Logs in again if the session cookie is about to expire, so no handler has to wait for it."""
+        if self.session_expires is None or self.session_expires - time.time() > SESSION_REFRESH_MARGIN: return
+        async with self._login_lock:
+            self.logged_in = await self._login()
+
+    async def _login(self) -> bool:
         try:
-            response = self.session.post(f"{self.base_url}login", data={'username': username, 'password': password}, verify=False)
+            response = await self.client.post(self._login_url, data={'username': self.username, 'password': self.password})
             response.raise_for_status()
-            if response.json().get('success'):
+            data = json_loads(response.content)
+            if data.get('success'):
+                self._logins += 1
+                self.session_expires = min((cookie.expires for cookie in self.client.cookies.jar if cookie.expires), default=None)
                 logger.info(f"Successfully logged into panel at {self.base_url}")
                 return True
-            logger.error(f"Failed to log into panel at {self.base_url}: {response.json().get('msg')}")
+            logger.error(f"Failed to log into panel at {self.base_url}: {data.get('msg')}")
             return False
-        except requests.exceptions.RequestException as e:
+        except (httpx.HTTPError, ValueError) as e:
             logger.error(f"Error connecting to panel at {self.base_url}: {e}")
             return False
 
-    def get_inbound(self, inbound_id: int) -> Optional[dict]:
-        if not self.logged_in: return None
-        try:
-            response = self.session.get(f"{self.base_url}panel/api/inbounds/get/{inbound_id}", verify=False)
-            response.raise_for_status()
-            data = response.json()
-            return data.get('obj') if data.get('success') else None
-        except requests.exceptions.RequestException as e:
-            logger.error(f"API Error getting inbound {inbound_id}: {e}")
-            return None
+    async def _relogin(self, logins: int) -> bool:
+        """Logs in again after a rejected request, unless a login already happened since it was sent."""
+        async with self._login_lock:
+            if self._logins == logins: self.logged_in = await self._login()
+        return self.logged_in
 
-    def add_client(self, inbound_id: int, client_settings: dict) -> bool:
+    async def _request(self, method: str, url: str, **kwargs) -> dict:
+        """Sends a request and returns its JSON body ({} if empty), logging in again once if the panel session has expired."""
+        logins = self._logins
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            if response.status_code in (401, 404) and await self._relogin(logins):
+                response = await self.client.request(method, url, **kwargs)
+        finally:
+            # Every POST changes clients, even one whose response we never saw
+            if method == "POST": self._invalidate_inbounds()
+        response.raise_for_status()
+        return json_loads(response.content) if response.content else {}
+
+    async def add_client(self, inbound_id: int, client_settings: dict) -> bool:
         if not self.logged_in: return False
         try:
-            payload = {'id': inbound_id, 'settings': json.dumps({"clients": [client_settings]})}
-            response = self.session.post(f"{self.base_url}panel/api/inbounds/addClient", data=payload, verify=False)
-            response.raise_for_status()
-            data = response.json()
+            payload = {'id': inbound_id, 'settings': json_dumps({"clients": [client_settings]})}
+            data = await self._request("POST", self._add_client_url, data=payload)
             if data.get('success'):
                 logger.info(f"API: Successfully added client {client_settings['email']} to inbound {inbound_id}")
                 return True
             logger.error(f"API Error adding client: {data.get('msg')}")
             return False
-        except requests.exceptions.RequestException as e:
+        except (httpx.HTTPError, ValueError) as e:
             logger.error(f"API Error adding client: {e}")
             return False
 
-    def update_client(self, client_uuid: str, inbound_id: int, client_settings: dict) -> bool:
+    async def update_client(self, client_uuid: str, inbound_id: int, client_settings: dict) -> bool:
         if not self.logged_in: return False
         try:
             payload = {
                 "id": inbound_id,
-                "settings": json.dumps({"clients": [client_settings]}, separators=(",",":"))
+                "settings": json_dumps({"clients": [client_settings]})
             }
-            response = self.session.post(f"{self.base_url}panel/api/inbounds/updateClient/{client_uuid}", json=payload, verify=False)
-            response.raise_for_status()
-            data = response.json()
+            data = await self._request("POST", f"{self._inbounds_url}updateClient/{client_uuid}", json=payload)
             if data.get('success'):
                 logger.info(f"API: Successfully updated client {client_uuid}")
                 return True
             logger.error(f"API Error updating client {client_uuid}: {data.get('msg')}")
             return False
-        except requests.exceptions.RequestException as e:
+        except (httpx.HTTPError, ValueError) as e:
             logger.error(f"API Error updating client {client_uuid}: {e}")
             return False
 
-    def delete_client(self, inbound_id: int, client_uuid: str) -> bool:
+    async def delete_client(self, inbound_id: int, client_uuid: str) -> bool:
         if not self.logged_in: return False
         try:
-            url = f"{self.base_url}panel/api/inbounds/{inbound_id}/delClient/{client_uuid}"
-            response = self.session.post(url, verify=False)
-            response.raise_for_status()
-            data = response.json()
+            url = f"{self._inbounds_url}{inbound_id}/delClient/{client_uuid}"
+            data = await self._request("POST", url)
             if data.get('success'):
                 logger.info(f"API: Successfully deleted client {client_uuid} from inbound {inbound_id}")
                 return True
             logger.error(f"API Error deleting client {client_uuid}: {data.get('msg')}")
             return False
-        except requests.exceptions.RequestException as e:
+        except (httpx.HTTPError, ValueError) as e:
             logger.error(f"API Error deleting client {client_uuid}: {e}")
             return False
 
-    def get_client_traffics(self, email: str) -> Optional[dict]:
+    async def list_inbounds(self, fresh: bool = False) -> Optional[list]:
+        """Returns every inbound on the panel, each including its clients' traffic in 'clientStats'.
+
+        The result is shared for INBOUNDS_CACHE_TTL seconds and dropped by any write through this client; don't mutate it.
+        Pass fresh=True when the clients will be written back, so edits made in the panel meanwhile aren't overwritten.
+        """
         if not self.logged_in: return None
+        snapshot = self._inbounds_snapshot
+        if not fresh and snapshot and time.monotonic() - snapshot[0] < INBOUNDS_CACHE_TTL: return snapshot[1]
+        writes = self._writes
         try:
-            encoded_email = quote(email)
-            response = self.session.get(f"{self.base_url}panel/api/inbounds/getClientTraffics/{encoded_email}", verify=False)
-            response.raise_for_status()
-            data = response.json()
-            return data.get('obj') if data.get('success') else None
-        except requests.exceptions.RequestException as e:
-            logger.error(f"API Error getting traffic for {email}: {e}")
+            data = await self._request("GET", self._list_url)
+            if not data.get('success'): return None
+            if writes == self._writes: self._inbounds_snapshot = (time.monotonic(), data.get('obj'))
+            return data.get('obj')
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error(f"API Error listing inbounds: {e}")
             return None
 
 
@@ -150,100 +242,389 @@ class XUIApi:
 # API-BASED HELPER FUNCTIONS
 # ==============================================================================
 
-def load_yaml(file_path: Path) -> dict:
-    if not file_path.exists(): return {}
+# Parsed data files keyed by path, stored as ((st_mtime_ns, st_size, st_ino), data).
+_file_cache: dict = {}
+
+def _file_signature(file_path: Path) -> tuple:
+    st = file_path.stat()
+    # The inode catches editors that save by renaming a new file over the old one within the same mtime tick
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+def _load_cached(file_path: Path, parse) -> dict:
+    """Returns the parsed file, re-parsing only when its mtime, size or inode changes."""
+    try:
+        signature = _file_signature(file_path)
+    except FileNotFoundError:
+        _file_cache.pop(file_path, None)
+        return {}
+    entry = _file_cache.get(file_path)
+    if entry and entry[0] == signature: return entry[1]
+    data = parse(file_path)
+    data = data if data is not None else {}
+    _file_cache[file_path] = (signature, data)
+    return data
+
+def _parse_yaml(file_path: Path) -> Any:
     with open(file_path, "r", encoding='utf-8') as f:
-        data = yaml.safe_load(f)
-        return data if data is not None else {}
+        return yaml.load(f, Loader=SafeLoader)
 
-def save_yaml(data: dict, file_path: Path) -> None:
-    with open(file_path, "w", encoding='utf-8') as f:
-        yaml.dump(data, f, indent=2, allow_unicode=True)
+def load_yaml(file_path: Path) -> dict:
+    return _load_cached(file_path, _parse_yaml)
 
-def generate_subscription_id(length: int = 16) -> str:
-    chars = string.ascii_lowercase + string.digits
-    return "".join(random.choice(chars) for _ in range(length))
+def load_config() -> dict:
+    """Returns the cached 'settings' section, with values derived from it computed once per load."""
+    config = load_yaml(CONFIG_FILE).get("settings", {})
+    if config and '_i18n' not in config:
+        # Everything is computed first and stored in one step, so a bad setting can't leave the cached dict half-derived
+        derived = {
+            '_langs': frozenset(config.get('welcome', {})),
+            # Localized messages flattened to {(key, lang): text}
+            '_i18n': {(key, lang): text for key, section in config.items() if isinstance(section, dict)
+                      for lang, text in section.items() if isinstance(text, str)},
+        }
+        try:
+            defaults = {k.strip(): v.strip() for k, v in (item.split('=', 1) for item in config.get('default', []))}
+            # Typed copies for the handlers' arithmetic; the raw strings stay for display
+            typed = {}
+            if 'total_gb' in defaults: typed['_default_gb'] = float(defaults['total_gb'])
+            if 'duration_days' in defaults: typed['_default_duration_ms'] = int(defaults['duration_days']) * DAYS_TO_MS
+            sub_dir = Path(config['subscription'].get('uri', 'sub'))
+            servers = tuple(ServerCtx(name, server_config['address'], server_config['panel_path'], get_inbound_ids(server_config))
+                            for name, server_config in config.get('db', {}).items())
+            derived.update(typed, _defaults=defaults, _sub_dir=sub_dir, _servers=servers)
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            # Messages still work; handlers that need the missing values fail as they would on the raw settings
+            logger.error(f"Invalid settings in {CONFIG_FILE}: {e!r}")
+        config.update(derived)
+    return config
+
+USER_COLUMNS = ("name", "language", "subscription", "quota")
+_users_conn: Optional[sqlite3.Connection] = None
+# Writes run in worker threads (asyncio.to_thread) on their own connection, one at a time;
+# WAL lets the event loop keep reading through _users_conn meanwhile
+_users_write_conn: Optional[sqlite3.Connection] = None
+_users_write_lock = threading.Lock()
+# Bumped on every write so derived data (the admin user picker) knows when to rebuild
+_users_version = 0
+
+def _create_users_table(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, name TEXT NOT NULL, language TEXT, subscription TEXT, quota REAL)")
+
+def _open_users_db(**kwargs) -> sqlite3.Connection:
+    conn = sqlite3.connect(USER_DB_FILE, **kwargs)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    _create_users_table(conn)
+    return conn
+
+def _users_db() -> sqlite3.Connection:
+    global _users_conn
+    if _users_conn is None: _users_conn = _open_users_db()
+    return _users_conn
+
+def _users_write_db() -> sqlite3.Connection:
+    global _users_write_conn
+    if _users_write_conn is None: _users_write_conn = _open_users_db(check_same_thread=False)
+    return _users_write_conn
+
+def _user_from_row(row: tuple) -> dict:
+    # Columns left NULL are omitted so callers' .get(key, default) fallbacks keep working
+    return {k: v for k, v in zip(USER_COLUMNS, row) if v is not None}
+
+def get_user(user_id: str) -> Optional[dict]:
+    row = _users_db().execute("SELECT name, language, subscription, quota FROM users WHERE id = ?", (user_id,)).fetchone()
+    return _user_from_row(row) if row else None
+
+def user_exists(user_id: str) -> bool:
+    return _users_db().execute("SELECT 1 FROM users WHERE id = ?", (user_id,)).fetchone() is not None
+
+def load_users() -> dict:
+    """Returns every user as {user_id: user}; only for admin views that need them all."""
+    return {row[0]: _user_from_row(row[1:]) for row in _users_db().execute("SELECT id, name, language, subscription, quota FROM users")}
+
+def save_user(user_id: str, user: dict) -> None:
+    global _users_version
+    with _users_write_lock:
+        with _users_write_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO users (id, name, language, subscription, quota) VALUES (?, ?, ?, ?, ?)",
+                         (user_id, *(user.get(k) for k in USER_COLUMNS)))
+        _users_version += 1
+
+def set_user_quota(user_id: str, quota: float) -> None:
+    global _users_version
+    with _users_write_lock:
+        with _users_write_db() as conn:
+            conn.execute("UPDATE users SET quota = ? WHERE id = ?", (quota, user_id))
+        _users_version += 1
+
+def delete_user(user_id: str) -> None:
+    global _users_version
+    with _users_write_lock:
+        with _users_write_db() as conn:
+            conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        _users_version += 1
+
+def migrate_legacy_users() -> None:
+    """One-shot import of the legacy users.yaml into users.db."""
+    if USER_DB_FILE.exists() or not LEGACY_USER_DB_FILE.exists(): return
+    users = load_yaml(LEGACY_USER_DB_FILE)
+    # Built under a temporary name and renamed, so an interrupted import is simply redone on the next start
+    tmp_path = USER_DB_FILE.with_name(f"{USER_DB_FILE.name}.tmp")
+    tmp_path.unlink(missing_ok=True)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        with conn:
+            _create_users_table(conn)
+            conn.executemany("INSERT OR REPLACE INTO users (id, name, language, subscription, quota) VALUES (?, ?, ?, ?, ?)",
+                             ((str(user_id), *(user.get(k) for k in USER_COLUMNS)) for user_id, user in users.items()))
+    finally:
+        conn.close()
+    os.replace(tmp_path, USER_DB_FILE)
+    logger.info(f"Migrated {len(users)} users from {LEGACY_USER_DB_FILE} to {USER_DB_FILE}")
+
+def write_subscription(sub_dir: Path, subscription_id: str, content: bytes) -> None:
+    """Writes a subscription file via a temp file and rename, so subs.py never serves a half-written one."""
+    # The pid keeps this from colliding with cron.py writing the same subscription
+    tmp_path = sub_dir / f".{subscription_id}.{os.getpid()}.tmp"
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    try:
+        fd = os.open(tmp_path, flags, 0o644)
+    except FileNotFoundError:
+        # Only the first write into a new subscription directory gets here
+        sub_dir.mkdir(parents=True, exist_ok=True)
+        fd = os.open(tmp_path, flags, 0o644)
+    try:
+        os.write(fd, content)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, sub_dir / subscription_id)
 
-def get_config_from_api(inbound_data: dict, email: str) -> Optional[str]:
+def generate_subscription_id(length: int = 16) -> str:
+    """Returns an unguessable URL-safe token; it is the only secret in a subscription URL."""
+    return secrets.token_urlsafe(length)[:length]
+
+# VLESS link parts shared by every client of an inbound, keyed by the raw inbound fields they derive from.
+_inbound_template_cache: dict = {}
+
+def get_inbound_template(inbound_data: dict) -> Optional[tuple]:
+    """Returns (link_suffix, fragment) for an inbound, parsing its stream settings and URL-encoding them once.
+
+    A client's link is f"vless://{uuid}{link_suffix}{fragment}"; fragment is None when the inbound has no remark.
+    """
+    key = (inbound_data.get("listen"), inbound_data.get("port"), inbound_data.get("streamSettings", "{}"), inbound_data.get("remark"))
+    if key in _inbound_template_cache: return _inbound_template_cache[key]
+    stream_settings = json_loads(inbound_data.get("streamSettings", "{}"))
+    listen_ip = inbound_data.get("listen")
+    port = inbound_data.get("port")
+    server_address = listen_ip if listen_ip and listen_ip not in ["127.0.0.1", "0.0.0.0", ""] else None
+    if stream_settings.get("externalProxy"):
+        proxy = stream_settings.get("externalProxy", [{}])[0]
+        server_address = proxy.get("dest", server_address)
+        port = proxy.get("port", port)
+    if not server_address:
+        logger.warning(f"Could not determine public server address for inbound {inbound_data['id']}. Skipping.")
+        _inbound_template_cache[key] = None
+        return None
+    params = {"encryption": "none"}
+    security_type = stream_settings.get("security")
+    params["security"] = security_type if security_type != "none" else ""
+    if security_type == "reality":
+        reality_settings = stream_settings.get("realitySettings", {})
+        nested_settings = reality_settings.get("settings", {})
+        params["pbk"] = nested_settings.get("publicKey")
+        params["fp"] = nested_settings.get("fingerprint")
+        params["sni"] = reality_settings.get("serverNames", [""])[0]
+        params["sid"] = reality_settings.get("shortIds", [""])[0]
+        params["spx"] = nested_settings.get("spiderX")
+    elif security_type == "tls":
+        tls_settings = stream_settings.get("tlsSettings", {})
+        nested_settings = tls_settings.get("settings", {})
+        params["sni"] = tls_settings.get("serverName")
+        params["fp"] = nested_settings.get("fingerprint")
+        alpn_list = tls_settings.get("alpn", [])
+        if alpn_list: params["alpn"] = ",".join(alpn_list)
+    network_type = stream_settings.get("network")
+    params["type"] = network_type
+    if network_type == "tcp":
+        tcp_settings = stream_settings.get("tcpSettings", {})
+        if tcp_settings.get("header", {}).get("type") == "http":
+            params["headerType"] = "http"
+            path_list = tcp_settings.get("header", {}).get("request", {}).get("path", [])
+            if path_list: params["path"] = path_list[0]
+    elif network_type == "ws":
+        ws_settings = stream_settings.get("wsSettings", {})
+        params["path"] = ws_settings.get("path")
+        host = ws_settings.get("headers", {}).get("Host")
+        if host: params["host"] = host
+    elif network_type == "grpc":
+        grpc_settings = stream_settings.get("grpcSettings", {})
+        params["serviceName"] = grpc_settings.get("serviceName")
+    elif network_type == "http":
+        http_settings = stream_settings.get("httpSettings", {})
+        params["path"] = http_settings.get("path")
+        host_list = http_settings.get("host", [])
+        if host_list: params["host"] = host_list[0]
+    elif network_type == "xhttp":
+        xhttp_settings = stream_settings.get("xhttpSettings", {})
+        params["path"] = xhttp_settings.get("path")
+        params["mode"] = xhttp_settings.get("mode")
+        host = xhttp_settings.get("host", "")
+        if host: params["host"] = host
+    params = {k: v for k, v in params.items() if v is not None and v != ""}
+    remark = inbound_data.get('remark')
+    template = (f"@{server_address}:{port}?{urlencode(params, quote_via=quote)}#", quote(remark) if remark is not None else None)
+    _inbound_template_cache[key] = template
+    return template
+
+def build_vless_link(inbound_data: dict, client_uuid: str, email: str) -> Optional[str]:
     try:
-        stream_settings = json.loads(inbound_data.get("streamSettings", "{}"))
-        settings = json.loads(inbound_data.get("settings", "{}"))
-        client_data = next((c for c in settings.get("clients", []) if c.get("email") == email), None)
-        if not client_data: return None
-        listen_ip = inbound_data.get("listen")
-        port = inbound_data.get("port")
-        server_address = listen_ip if listen_ip and listen_ip not in ["127.0.0.1", "0.0.0.0", ""] else None
-        if stream_settings.get("externalProxy"):
-            proxy = stream_settings.get("externalProxy", [{}])[0]
-            server_address = proxy.get("dest", server_address)
-            port = proxy.get("port", port)
-        if not server_address:
-            logger.warning(f"Could not determine public server address for inbound {inbound_data['id']}. Skipping.")
-            return None
-        params = {"encryption": "none"}
-        security_type = stream_settings.get("security")
-        params["security"] = security_type if security_type != "none" else ""
-        if security_type == "reality":
-            reality_settings = stream_settings.get("realitySettings", {})
-            nested_settings = reality_settings.get("settings", {})
-            params["pbk"] = nested_settings.get("publicKey")
-            params["fp"] = nested_settings.get("fingerprint")
-            params["sni"] = reality_settings.get("serverNames", [""])[0]
-            params["sid"] = reality_settings.get("shortIds", [""])[0]
-            params["spx"] = nested_settings.get("spiderX")
-        elif security_type == "tls":
-            tls_settings = stream_settings.get("tlsSettings", {})
-            nested_settings = tls_settings.get("settings", {})
-            params["sni"] = tls_settings.get("serverName")
-            params["fp"] = nested_settings.get("fingerprint")
-            alpn_list = tls_settings.get("alpn", [])
-            if alpn_list: params["alpn"] = ",".join(alpn_list)
-        network_type = stream_settings.get("network")
-        params["type"] = network_type
-        if network_type == "tcp":
-            tcp_settings = stream_settings.get("tcpSettings", {})
-            if tcp_settings.get("header", {}).get("type") == "http":
-                params["headerType"] = "http"
-                path_list = tcp_settings.get("header", {}).get("request", {}).get("path", [])
-                if path_list: params["path"] = path_list[0]
-        elif network_type == "ws":
-            ws_settings = stream_settings.get("wsSettings", {})
-            params["path"] = ws_settings.get("path")
-            host = ws_settings.get("headers", {}).get("Host")
-            if host: params["host"] = host
-        elif network_type == "grpc":
-            grpc_settings = stream_settings.get("grpcSettings", {})
-            params["serviceName"] = grpc_settings.get("serviceName")
-        elif network_type == "http":
-            http_settings = stream_settings.get("httpSettings", {})
-            params["path"] = http_settings.get("path")
-            host_list = http_settings.get("host", [])
-            if host_list: params["host"] = host_list[0]
-        elif network_type == "xhttp":
-            xhttp_settings = stream_settings.get("xhttpSettings", {})
-            params["path"] = xhttp_settings.get("path")
-            params["mode"] = xhttp_settings.get("mode")
-            host = xhttp_settings.get("host", "")
-            if host: params["host"] = host
-        params = {k: v for k, v in params.items() if v is not None and v != ""}
-        base_url = f"vless://{client_data['id']}@{server_address}:{port}"
-        query_string = urlencode(params, quote_via=quote)
-        config_name = inbound_data.get('remark', f"Config-{email.split('#')[0]}")
-        return f"{base_url}?{query_string}#{quote(config_name)}"
+        template = get_inbound_template(inbound_data)
+        if not template: return None
+        link_suffix, fragment = template
+        if fragment is None: fragment = quote(f"Config-{email.split('#')[0]}")
+        return f"vless://{client_uuid}{link_suffix}{fragment}"
     except (json.JSONDecodeError, KeyError, IndexError, TypeError) as e:
-        logger.error(f"Failed to reconstruct config for email {email} from API data: {e}", exc_info=True)
+        logger.error(f"Failed to build config for email {email} from API data: {e}", exc_info=True)
         return None
 
+def get_inbound_ids(server_config: dict) -> list:
+    inbounds = server_config.get('inbound', [])
+    return inbounds if isinstance(inbounds, list) else [inbounds]
+
+async def get_user_traffic(api: XUIApi, inbound_ids: list, user_id: str) -> tuple:
+    """Sums a user's up+down bytes across the given inbounds of one panel with a single list call.
+
+    Returns (used_bytes, expiry_ms); expiry_ms is None when the user has no client on those inbounds.
+    """
+    # Only the configured inbounds are scanned, and each client's email can only match once
+    pending = {inbound_id: f"{user_id}#{inbound_id}" for inbound_id in inbound_ids}
+    used_bytes, expiry_ms = 0, None
+    for inbound in await api.list_inbounds() or []:
+        email = pending.pop(inbound.get('id'), None)
+        if email is None: continue
+        stat = next((stat for stat in inbound.get('clientStats') or [] if stat.get('email') == email), None)
+        if stat:
+            used_bytes += stat.get('up', 0) + stat.get('down', 0)
+            if expiry_ms is None: expiry_ms = stat.get('expiryTime', 0)
+        if not pending: break
+    return used_bytes, expiry_ms
+
+async def find_user_clients(api: XUIApi, inbound_ids: list, user_id: str) -> list:
+    """Returns (inbound_id, client_settings) for each of the user's clients on one panel, from a single fresh list call."""
+    inbounds_by_id = {inbound.get('id'): inbound for inbound in await api.list_inbounds(fresh=True) or []}
+    found = []
+    for inbound_id in inbound_ids:
+        inbound_data = inbounds_by_id.get(inbound_id)
+        if not inbound_data: continue
+        client_email = f"{user_id}#{inbound_id}"
+        client = api.clients_by_email(inbound_data).get(client_email)
+        if client: found.append((inbound_id, client))
+        else: logger.warning(f"Client {client_email} not found in inbound {inbound_id}.")
+    return found
+
+async def update_user_clients(api: XUIApi, inbound_ids: list, user_id: str, total_bytes: int, expiry_ms: int) -> int:
+    updated = 0
+    for inbound_id, client in await find_user_clients(api, inbound_ids, user_id):
+        client_to_update = {**client, 'totalGB': total_bytes, 'expiryTime': expiry_ms}
+        if await api.update_client(client_to_update['id'], inbound_id, client_to_update): updated += 1
+    return updated
+
+async def delete_user_clients(api: XUIApi, inbound_ids: list, user_id: str) -> int:
+    deleted = 0
+    for inbound_id, client_to_delete in await find_user_clients(api, inbound_ids, user_id):
+        if 'id' in client_to_delete and await api.delete_client(inbound_id, client_to_delete['id']): deleted += 1
+    return deleted
+
+async def run_per_panel(apis: dict, config: dict, func, *args) -> list:
+    """Awaits func(api, inbound_ids, *args) for every logged-in panel concurrently, returning results in config order."""
+    return await asyncio.gather(*(func(apis[server.name], server.inbound_ids, *args) for server in config['_servers'] if server.name in apis))
+
+async def fetch_user_traffic(apis: dict, config: dict, user_id: str) -> tuple:
+    """Queries every logged-in panel concurrently for a user's traffic.
+
+    Returns (total_used_bytes, expiry_ms) where expiry_ms comes from the first panel, in config
+    order, that has the user, or is None if none has.
+    """
+    total_used_bytes, expiry_ms = 0, None
+    for used_bytes, server_expiry_ms in await run_per_panel(apis, config, get_user_traffic, user_id):
+        if server_expiry_ms is None: continue
+        total_used_bytes += used_bytes
+        if expiry_ms is None: expiry_ms = server_expiry_ms
+    return total_used_bytes, expiry_ms
+
+async def provision_user(api: XUIApi, inbound_ids: list, user_id: str, tg_id: Any, total_bytes: int, expiry_ms: int) -> list:
+    """Adds the user's client to each inbound of one panel and returns their VLESS links.
+
+    Inbounds are fetched with one list call and links are built from the client ids we generate,
+    so the inbounds' client settings are only parsed when an add fails.
+    """
+    inbounds_by_id = {inbound.get('id'): inbound for inbound in await api.list_inbounds() or []}
+    links = []
+    for inbound_id in inbound_ids:
+        email = f"{user_id}#{inbound_id}"
+        client_payload = { "id": str(uuid.uuid4()), "email": email, "enable": True, "tgId": tg_id, "totalGB": total_bytes, "expiryTime": expiry_ms, "subId": str(uuid.uuid4().hex)[:16], "reset": 0, "flow": "", "limitIp": 0 }
+        client_id = client_payload['id']
+        if not await api.add_client(inbound_id, client_payload):
+            # Usually the email is already taken by a client left from an earlier, interrupted registration:
+            # link to that one.
+            inbounds_by_id = {inbound.get('id'): inbound for inbound in await api.list_inbounds(fresh=True) or []}
+            inbound_data = inbounds_by_id.get(inbound_id)
+            existing = api.clients_by_email(inbound_data).get(email) if inbound_data else None
+            if not existing or 'id' not in existing: continue
+            client_id = existing['id']
+        inbound_data = inbounds_by_id.get(inbound_id)
+        if inbound_data:
+            link = build_vless_link(inbound_data, client_id, email)
+            if link: links.append(link)
+    return links
+
+# Panel clients kept alive across updates, keyed by (address, panel_path, user).
+_api_pool: dict = {}
+
+# aclose() tasks for replaced panel clients, referenced until they finish
+_closing_clients: set = set()
+
+def _close_later(api: XUIApi) -> None:
+    task = asyncio.get_running_loop().create_task(api.client.aclose())
+    _closing_clients.add(task)
+    task.add_done_callback(_closing_clients.discard)
+
+def get_api(server: ServerCtx, config: dict) -> XUIApi:
+    """Returns the pooled client for a panel, creating it on first use; call ensure_login() before use."""
+    user, password = config['subscription']['user'], config['subscription']['password']
+    key = (server.address, server.panel_path, user)
+    api = _api_pool.get(key)
+    if api is None or api.password != password:
+        if api is not None: _close_later(api)
+        api = _api_pool[key] = XUIApi(server.address, server.panel_path, user, password)
+    return api
+
+async def connect_panels(config: dict) -> dict:
+    """Returns {server_name: XUIApi} for every configured panel that is logged in, logging in concurrently."""
+    apis = {server.name: get_api(server, config) for server in config['_servers']}
+    logged_in = await asyncio.gather(*(api.ensure_login() for api in apis.values()))
+    return {server_name: api for (server_name, api), ok in zip(apis.items(), logged_in) if ok}
+
 def get_user_language_from_update(update: Update, config: dict) -> str:
-    return update.effective_user.language_code if update.effective_user.language_code in config.get("welcome", {}) else "en"
+    lang_code = update.effective_user.language_code
+    return lang_code if lang_code in config.get('_langs', ()) else "en"
     
-def get_localized_message(key: str, lang: str, config: dict) -> str: return config.get(key, {}).get(lang, config.get(key, {}).get("en", "Message not found."))
+def get_localized_message(key: str, lang: str, config: dict) -> str:
+    i18n = config.get('_i18n', {})
+    text = i18n.get((key, lang))
+    return text if text is not None else i18n.get((key, "en"), "Message not found.")
+
+def now_ms() -> int: return time.time_ns() // 1_000_000
+
+def time_left_ms(expiry_ms: int) -> int:
+    """Milliseconds until a panel expiryTime; expiries <= 0 never run out and count as 9999 days."""
+    return expiry_ms - now_ms() if expiry_ms > 0 else 9999 * DAYS_TO_MS
 
-def format_timedelta(delta: timedelta) -> str:
-    if delta.total_seconds() < 0: return "Expired"
-    days = delta.days
-    hours, remainder = divmod(delta.seconds, 3600)
-    minutes, _ = divmod(remainder, 60)
+def format_time_left(left_ms: int) -> str:
+    if left_ms < 0: return "Expired"
+    hours, minutes = divmod(left_ms // 60_000, 60)
+    days, hours = divmod(hours, 24)
     return f"{days}d {hours}h {minutes}m"
 
 # ==============================================================================
@@ -252,60 +633,40 @@ def format_timedelta(delta: timedelta) -> str:
 
 async def register_new_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    config_data = load_yaml(CONFIG_FILE)
-    config = config_data.get("settings", {})
-    users_db = load_yaml(USER_DB_FILE)
+    config = load_config()
     
     user_id = str(user.id)
     logger.info(f"Registering new user: {user_id} ({user.full_name})")
     
-    defaults = {k.strip(): v.strip() for k, v in (item.split('=') for item in config['default'])}
-    
-    now_ms = int(time.time() * 1000)
-    expiry_ms = now_ms + (int(defaults['duration_days']) * DAYS_TO_MS)
-    total_bytes = int(float(defaults['total_gb']) * GB_TO_BYTES)
-    
-    for server_name, server_config in config['db'].items():
-        api = XUIApi(server_config['address'], server_config['panel_path'], config['subscription']['user'], config['subscription']['password'])
-        if not api.logged_in: continue
-        inbounds = server_config.get('inbound', [])
-        if not isinstance(inbounds, list): inbounds = [inbounds]
-        for inbound_id in inbounds:
-            client_email = f"{user_id}#{inbound_id}"
-            client_payload = { "id": str(uuid.uuid4()), "email": client_email, "enable": True, "tgId": user.id, "totalGB": total_bytes, "expiryTime": expiry_ms, "subId": str(uuid.uuid4().hex)[:16], "reset": 0, "flow": "", "limitIp": 0 }
-            api.add_client(inbound_id, client_payload)
-
-    all_vless_links = []
-    for server_name, server_config in config['db'].items():
-        api = XUIApi(server_config['address'], server_config['panel_path'], config['subscription']['user'], config['subscription']['password'])
-        if not api.logged_in: continue
-        inbounds = server_config.get('inbound', [])
-        if not isinstance(inbounds, list): inbounds = [inbounds]
-        for inbound_id in inbounds:
-            inbound_data = api.get_inbound(inbound_id)
-            if inbound_data:
-                link = get_config_from_api(inbound_data, f"{user_id}#{inbound_id}")
-                if link: all_vless_links.append(link)
+    defaults = config['_defaults']
+    
+    expiry_ms = now_ms() + config['_default_duration_ms']
+    total_bytes = int(config['_default_gb'] * GB_TO_BYTES)
+    
+    apis = await connect_panels(config)
+
+    # Newline-joined links, built in place rather than via a list + join
+    all_vless_links = bytearray()
+    for links in await run_per_panel(apis, config, provision_user, user_id, user.id, total_bytes, expiry_ms):
+        for link in links:
+            if all_vless_links: all_vless_links += b"\n"
+            all_vless_links += link.encode('utf-8')
 
     if not all_vless_links:
         await update.message.reply_text("Error creating subscription file. Please contact support.")
         return
 
     subscription_id = generate_subscription_id()
-    encoded_content = base64.b64encode("\n".join(all_vless_links).encode('utf-8')).decode('utf-8')
-    sub_dir = Path(config['subscription'].get('uri', 'sub'))
-    sub_dir.mkdir(exist_ok=True)
-    (sub_dir / subscription_id).write_text(encoded_content, encoding='utf-8')
+    await asyncio.to_thread(write_subscription, config['_sub_dir'], subscription_id, base64.b64encode(all_vless_links))
 
-    users_db[user_id] = {
+    lang = get_user_language_from_update(update, config)
+    await asyncio.to_thread(save_user, user_id, {
         "name": user.full_name, 
-        "language": get_user_language_from_update(update, config), 
+        "language": lang, 
         "subscription": subscription_id,
-        "quota": float(defaults['total_gb'])
-    }
-    save_yaml(users_db, USER_DB_FILE)
+        "quota": config['_default_gb']
+    })
     
-    lang = users_db[user_id]['language']
     subscription_name = config['subscription'].get('name', 'VPN') 
     sub_url = f"{config['subscription']['url']}/{subscription_id}#{quote(subscription_name)}"
     welcome_msg = get_localized_message("welcome", lang, config).format(
@@ -320,19 +681,35 @@ async def register_new_user(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ==============================================================================
 
 KEYBOARD_MARKUP = ReplyKeyboardMarkup([["/status"], ["/help", "/contact"]], resize_keyboard=True)
+# Static inline keyboards of the admin /edit and /new flows
+DURATION_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("30d", callback_data="edit_dur_30"), InlineKeyboardButton("90d", callback_data="edit_dur_90"), InlineKeyboardButton("365d", callback_data="edit_dur_365")], 
+    [InlineKeyboardButton("Cancel", callback_data="cancel")]
+])
+QUOTA_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("2.1GB", callback_data="edit_quota_2.1"), InlineKeyboardButton("3.5GB", callback_data="edit_quota_3.5"), InlineKeyboardButton("7GB", callback_data="edit_quota_7")], 
+    [InlineKeyboardButton("14GB", callback_data="edit_quota_14"), InlineKeyboardButton("35GB", callback_data="edit_quota_35"), InlineKeyboardButton("70GB", callback_data="edit_quota_70")], 
+    [InlineKeyboardButton("Cancel", callback_data="cancel")]
+])
+LANGUAGE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("English", callback_data="en"), InlineKeyboardButton("Español", callback_data="es")],
+    [InlineKeyboardButton("Français", callback_data="fr"), InlineKeyboardButton("Русский", callback_data="ru")],
+    [InlineKeyboardButton("中文(简体)", callback_data="zh-hans")],
+    [InlineKeyboardButton("Cancel", callback_data="cancel")]
+])
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(update.effective_user.id)
-    if user_id not in load_yaml(USER_DB_FILE):
+    if not user_exists(user_id):
         await register_new_user(update, context)
     else:
         await status_command(update, context)
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(update.effective_user.id)
-    users_db = load_yaml(USER_DB_FILE)
+    user_info = get_user(user_id)
 
-    if user_id == ADMIN_ID and user_id not in users_db:
+    if user_id == ADMIN_ID and user_info is None:
         admin_msg = ("🤖 Bot is running.\n"
                      "You are the admin, but you don't have a personal subscription managed by this bot. "
                      "To create one for yourself, please use the /start command.\n\n"
@@ -340,49 +717,32 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text(admin_msg, parse_mode=ParseMode.MARKDOWN)
         return
     
-    if user_id not in users_db:
+    if user_info is None:
         await register_new_user(update, context)
         return
 
-    config_data = load_yaml(CONFIG_FILE)
-    config = config_data.get("settings", {})
-    total_used_bytes = 0 # <-- FIX: Renamed variable
-    master_client_info = None
-    found_on_panels = False
-
-    for server_name, server_config in config['db'].items():
-        api = XUIApi(server_config['address'], server_config['panel_path'], config['subscription']['user'], config['subscription']['password'])
-        if not api.logged_in: continue
-        inbounds = server_config.get('inbound', [])
-        if not isinstance(inbounds, list): inbounds = [inbounds]
-        for inbound_id in inbounds:
-            client_email = f"{user_id}#{inbound_id}"
-            traffic_data = api.get_client_traffics(client_email)
-            if traffic_data:
-                found_on_panels = True
-                # --- FIX: Sum both UP and DOWN traffic ---
-                total_used_bytes += traffic_data.get('up', 0) + traffic_data.get('down', 0)
-                if master_client_info is None:
-                    master_client_info = {'expiry': traffic_data.get('expiryTime', 0)}
-    
-    if not found_on_panels:
+    config = load_config()
+    apis = await connect_panels(config)
+    total_used_bytes, expiry_ms = await fetch_user_traffic(apis, config, user_id)
+    
+    if expiry_ms is None:
         await update.message.reply_text("Could not retrieve your status. Please contact support.", reply_markup=KEYBOARD_MARKUP)
         return
 
-    lang = users_db[user_id]['language']
-    expiry_delta = timedelta(milliseconds=(master_client_info['expiry'] - (time.time() * 1000))) if master_client_info['expiry'] > 0 else timedelta(days=9999)
+    lang = user_info['language']
+    left_ms = time_left_ms(expiry_ms)
     
-    if expiry_delta.total_seconds() < 0:
+    if left_ms < 0:
         await update.message.reply_text(get_localized_message("trial_end", lang, config), reply_markup=KEYBOARD_MARKUP)
         return
     
-    defaults = {k.strip(): v.strip() for k, v in (item.split('=') for item in config['default'])}
-    subscription_id = users_db[user_id]['subscription']
+    defaults = config['_defaults']
+    subscription_id = user_info['subscription']
     subscription_name = config['subscription'].get('name', 'VPN')
     sub_url = f"{config['subscription']['url']}/{subscription_id}#{quote(subscription_name)}"
     
     used_gb = total_used_bytes / GB_TO_BYTES # <-- FIX: Use correct variable
-    total_gb = users_db[user_id].get('quota', float(defaults['total_gb']))
+    total_gb = user_info.get('quota', config['_default_gb'])
     remaining_gb = max(0, total_gb - used_gb)
 
     message_key = "quota_exceeded" if total_gb > 0 and remaining_gb <= 0 else "status"
@@ -392,7 +752,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         used_gb=f"{remaining_gb:.2f}", 
         total_gb=f"{total_gb:.2f}",
         reset=defaults.get('reset_days', 0),
-        expiration_date=format_timedelta(expiry_delta)
+        expiration_date=format_time_left(left_ms)
     )
     
     if user_id == ADMIN_ID:
@@ -404,24 +764,22 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    config = load_yaml(CONFIG_FILE).get("settings", {})
-    users_db = load_yaml(USER_DB_FILE)
+    config = load_config()
     user_id = str(update.effective_user.id)
-    lang = users_db.get(user_id, {}).get('language', 'en')
+    lang = (get_user(user_id) or {}).get('language', 'en')
     await update.message.reply_text(get_localized_message("help", lang, config), parse_mode=ParseMode.MARKDOWN, reply_markup=KEYBOARD_MARKUP)
 
 
 async def contact_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    config = load_yaml(CONFIG_FILE).get("settings", {})
-    users_db = load_yaml(USER_DB_FILE)
+    config = load_config()
     user_id = str(update.effective_user.id)
-    lang = users_db.get(user_id, {}).get('language', 'en')
+    lang = (get_user(user_id) or {}).get('language', 'en')
     await update.message.reply_text(get_localized_message("contact", lang, config), reply_markup=KEYBOARD_MARKUP)
 
 
 async def handle_text_messages(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(update.effective_user.id)
-    if user_id not in load_yaml(USER_DB_FILE):
+    if not user_exists(user_id):
         await register_new_user(update, context)
     else:
         try:
@@ -443,19 +801,61 @@ async def cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # ADMIN /edit COMMAND
 # ==============================================================================
 
-def build_user_keyboard(users: dict, prefix: str) -> InlineKeyboardMarkup:
-    buttons = [InlineKeyboardButton(f"{data['name']} ({user_id})", callback_data=f"{prefix}{user_id}") for user_id, data in sorted(users.items(), key=lambda item: item[1]['name'].lower())]
+# Users sorted case-insensitively by name, as (users version, [(user_id, name), ...])
+_sorted_users_cache: Optional[tuple] = None
+# Admin user picker pages keyed by (action, page), stored as (users version, markup)
+_user_keyboard_cache: dict = {}
+
+def sorted_users() -> list:
+    """Returns [(user_id, name)] sorted by name, re-querying users.db only after a write."""
+    global _sorted_users_cache
+    signature = _users_version
+    if _sorted_users_cache and _sorted_users_cache[0] == signature: return _sorted_users_cache[1]
+    # Sorted here rather than with ORDER BY lower(name): SQLite's lower() only folds ASCII
+    entries = [(name.lower(), user_id, name) for user_id, name in _users_db().execute("SELECT id, name FROM users")]
+    entries.sort(key=operator.itemgetter(0))
+    users = [(user_id, name) for _, user_id, name in entries]
+    _sorted_users_cache = (signature, users)
+    return users
+
+def build_user_keyboard(action: str, page: int = 0) -> Optional[InlineKeyboardMarkup]:
+    """Returns one page of the admin user picker for action ('edit' or 'delete'), or None when there are no users."""
+    signature = _users_version
+    users = sorted_users()
+    if not users: return None
+    page = max(0, min(page, (len(users) - 1) // USER_PAGE_SIZE))
+    entry = _user_keyboard_cache.get((action, page))
+    if entry and entry[0] == signature: return entry[1]
+    start = page * USER_PAGE_SIZE
+    buttons = [InlineKeyboardButton(f"{name} ({user_id})", callback_data=f"{action}_user_{user_id}") for user_id, name in users[start:start + USER_PAGE_SIZE]]
     keyboard = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    nav = []
+    if page > 0: nav.append(InlineKeyboardButton("« Prev", callback_data=f"{action}_page_{page - 1}"))
+    if start + USER_PAGE_SIZE < len(users): nav.append(InlineKeyboardButton("Next »", callback_data=f"{action}_page_{page + 1}"))
+    if nav: keyboard.append(nav)
     keyboard.append([InlineKeyboardButton("Cancel", callback_data="cancel")])
-    return InlineKeyboardMarkup(keyboard)
+    markup = InlineKeyboardMarkup(keyboard)
+    _user_keyboard_cache[(action, page)] = (signature, markup)
+    return markup
+
+async def user_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    action, _, page = query.data.split("_")
+    markup = build_user_keyboard(action, int(page))
+    if markup is None:
+        await query.edit_message_text("No users found.")
+        return ConversationHandler.END
+    await query.edit_message_reply_markup(reply_markup=markup)
+    return SELECT_USER if action == "edit" else DELETE_USER_SELECT
 
 async def edit_command_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if str(update.effective_user.id) != ADMIN_ID: return ConversationHandler.END
-    users_db = load_yaml(USER_DB_FILE)
-    if not users_db:
+    markup = build_user_keyboard("edit")
+    if markup is None:
         await update.message.reply_text("No users found.")
         return ConversationHandler.END
-    await update.message.reply_text("Select a user to edit:", reply_markup=build_user_keyboard(users_db, "edit_user_"))
+    await update.message.reply_text("Select a user to edit:", reply_markup=markup)
     return SELECT_USER
 
 async def select_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -464,53 +864,32 @@ async def select_user_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id_to_edit = query.data.replace("edit_user_", "")
     context.user_data['user_to_edit'] = user_id_to_edit
     
-    users_db = load_yaml(USER_DB_FILE)
-    user_info = users_db.get(user_id_to_edit)
-    config_data = load_yaml(CONFIG_FILE)
-    config = config_data.get("settings", {})
-    
-    total_used_bytes, client_info = 0, None # <-- FIX: Renamed variable
-    for server_config in config['db'].values():
-        api = XUIApi(server_config['address'], server_config['panel_path'], config['subscription']['user'], config['subscription']['password'])
-        if not api.logged_in: continue
-        inbounds = server_config.get('inbound', [])
-        if not isinstance(inbounds, list): inbounds = [inbounds]
-        for inbound_id in inbounds:
-            traffic = api.get_client_traffics(f"{user_id_to_edit}#{inbound_id}")
-            if traffic:
-                # --- FIX: Sum both UP and DOWN traffic ---
-                total_used_bytes += traffic.get('up', 0) + traffic.get('down', 0)
-                if not client_info: client_info = {'expiry': traffic.get('expiryTime', 0)}
+    user_info = get_user(user_id_to_edit)
+    context.user_data['user_name'] = user_info['name']
+    config = load_config()
+    
+    apis = await connect_panels(config)
+    total_used_bytes, expiry_ms = await fetch_user_traffic(apis, config, user_id_to_edit)
     
     used_gb = total_used_bytes / GB_TO_BYTES # <-- FIX: Use correct variable
-    total_gb = users_db[user_id_to_edit].get('quota', 0)
+    total_gb = user_info.get('quota', 0)
     remaining_gb = max(0, total_gb - used_gb)
     
-    expiry_delta = timedelta(milliseconds=(client_info['expiry'] - (time.time() * 1000))) if client_info and client_info['expiry'] > 0 else timedelta(days=9999)
-    expiry_date = "N/A" if not client_info else format_timedelta(expiry_delta)
+    expiry_date = "N/A" if expiry_ms is None else format_time_left(time_left_ms(expiry_ms))
     
     details_text = (f"Editing *{user_info['name']}* (`{user_id_to_edit}`)\n"
         f"Language: `{user_info['language']}`\n"
         f"Data Left: `{remaining_gb:.2f} GB / {total_gb:.2f} GB`\n"
         f"Expires in: `{expiry_date}`\n\n"
         "Set new expiration (days from now):")
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("30d", callback_data="edit_dur_30"), InlineKeyboardButton("90d", callback_data="edit_dur_90"), InlineKeyboardButton("365d", callback_data="edit_dur_365")], 
-        [InlineKeyboardButton("Cancel", callback_data="cancel")]
-    ])
-    await query.edit_message_text(text=details_text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
+    await query.edit_message_text(text=details_text, reply_markup=DURATION_MARKUP, parse_mode=ParseMode.MARKDOWN)
     return SELECT_DURATION
 
 async def select_duration_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     context.user_data['new_duration'] = int(query.data.replace("edit_dur_", ""))
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("2.1GB", callback_data="edit_quota_2.1"), InlineKeyboardButton("3.5GB", callback_data="edit_quota_3.5"), InlineKeyboardButton("7GB", callback_data="edit_quota_7")], 
-        [InlineKeyboardButton("14GB", callback_data="edit_quota_14"), InlineKeyboardButton("35GB", callback_data="edit_quota_35"), InlineKeyboardButton("70GB", callback_data="edit_quota_70")], 
-        [InlineKeyboardButton("Cancel", callback_data="cancel")]
-    ])
-    await query.edit_message_text(text="Select new quota (GB):", reply_markup=keyboard)
+    await query.edit_message_text(text="Select new quota (GB):", reply_markup=QUOTA_MARKUP)
     return SELECT_QUOTA
 
 async def select_quota_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -521,38 +900,16 @@ async def select_quota_callback(update: Update, context: ContextTypes.DEFAULT_TY
     new_duration = context.user_data['new_duration']
     new_quota = float(query.data.replace("edit_quota_", ""))
     
-    config_data = load_yaml(CONFIG_FILE)
-    config = config_data.get("settings", {})
-    now_ms = int(time.time() * 1000)
-    new_expiry_ms = now_ms + (new_duration * DAYS_TO_MS)
+    config = load_config()
+    new_expiry_ms = now_ms() + (new_duration * DAYS_TO_MS)
     new_total_bytes = int(new_quota * GB_TO_BYTES)
     
-    success_count = 0
-    for server_config in config['db'].values():
-        api = XUIApi(server_config['address'], server_config['panel_path'], config['subscription']['user'], config['subscription']['password'])
-        if not api.logged_in: continue
-        inbounds = server_config.get('inbound', [])
-        if not isinstance(inbounds, list): inbounds = [inbounds]
-        for inbound_id in inbounds:
-            inbound_data = api.get_inbound(inbound_id)
-            if not inbound_data: continue
-            settings = json.loads(inbound_data.get("settings", "{}"))
-            client_email = f"{user_id}#{inbound_id}"
-            client_to_update = next((c for c in settings.get("clients", []) if c.get("email") == client_email), None)
-            if client_to_update:
-                client_uuid = client_to_update['id']
-                client_to_update['totalGB'] = new_total_bytes
-                client_to_update['expiryTime'] = new_expiry_ms
-                if api.update_client(client_uuid, inbound_id, client_to_update):
-                    success_count += 1
-            else:
-                logger.warning(f"Client {client_email} not found in inbound {inbound_id} during edit.")
-    
-    users_db = load_yaml(USER_DB_FILE)
-    users_db[user_id]['quota'] = new_quota
-    save_yaml(users_db, USER_DB_FILE)
-    
-    user_name = users_db.get(user_id, {}).get("name", "Unknown")
+    apis = await connect_panels(config)
+    success_count = sum(await run_per_panel(apis, config, update_user_clients, user_id, new_total_bytes, new_expiry_ms))
+    
+    await asyncio.to_thread(set_user_quota, user_id, new_quota)
+    
+    user_name = context.user_data.get('user_name', "Unknown")
     await query.edit_message_text(text=f"User *{user_name}* updated successfully! ({success_count} clients modified)", parse_mode=ParseMode.MARKDOWN)
     context.user_data.clear()
     return ConversationHandler.END
@@ -570,8 +927,7 @@ async def new_command_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def new_get_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.message.text.strip()
     if not user_id: return NEW_GET_ID
-    users_db = load_yaml(USER_DB_FILE)
-    if user_id in users_db:
+    if user_exists(user_id):
         await update.message.reply_text("This ID already exists. Please choose another one or /cancel.")
         return NEW_GET_ID
     context.user_data['new_user_id'] = user_id
@@ -580,13 +936,7 @@ async def new_get_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def new_get_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_user_name'] = update.message.text.strip()
-    keyboard = InlineKeyboardMarkup([
-        [InlineKeyboardButton("English", callback_data="en"), InlineKeyboardButton("Español", callback_data="es")],
-        [InlineKeyboardButton("Français", callback_data="fr"), InlineKeyboardButton("Русский", callback_data="ru")],
-        [InlineKeyboardButton("中文(简体)", callback_data="zh-hans")],
-        [InlineKeyboardButton("Cancel", callback_data="cancel")]
-    ])
-    await update.message.reply_text("Finally, select a language for the user.", reply_markup=keyboard)
+    await update.message.reply_text("Finally, select a language for the user.", reply_markup=LANGUAGE_MARKUP)
     return NEW_GET_LANG
 
 async def new_get_lang(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -599,49 +949,29 @@ async def new_get_lang(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     
     await query.edit_message_text(f"Creating user '{user_name}' with ID '{user_id}'. Please wait...")
 
-    config_data = load_yaml(CONFIG_FILE)
-    config = config_data.get("settings", {})
-    users_db = load_yaml(USER_DB_FILE)
-    defaults = {k.strip(): v.strip() for k, v in (item.split('=') for item in config['default'])}
-    
-    now_ms = int(time.time() * 1000)
-    expiry_ms = now_ms + (int(defaults['duration_days']) * DAYS_TO_MS)
-    total_bytes = int(float(defaults['total_gb']) * GB_TO_BYTES)
-    
-    for server_name, server_config in config['db'].items():
-        api = XUIApi(server_config['address'], server_config['panel_path'], config['subscription']['user'], config['subscription']['password'])
-        if not api.logged_in: continue
-        inbounds = server_config.get('inbound', [])
-        if not isinstance(inbounds, list): inbounds = [inbounds]
-        for inbound_id in inbounds:
-            client_email = f"{user_id}#{inbound_id}"
-            client_payload = { "id": str(uuid.uuid4()), "email": client_email, "enable": True, "tgId": "", "totalGB": total_bytes, "expiryTime": expiry_ms, "subId": str(uuid.uuid4().hex)[:16], "reset": 0, "flow": "", "limitIp": 0 }
-            api.add_client(inbound_id, client_payload)
+    config = load_config()
+    defaults = config['_defaults']
+    
+    expiry_ms = now_ms() + config['_default_duration_ms']
+    total_bytes = int(config['_default_gb'] * GB_TO_BYTES)
+    
+    apis = await connect_panels(config)
             
-    all_vless_links = []
-    for server_name, server_config in config['db'].items():
-        api = XUIApi(server_config['address'], server_config['panel_path'], config['subscription']['user'], config['subscription']['password'])
-        if not api.logged_in: continue
-        inbounds = server_config.get('inbound', [])
-        if not isinstance(inbounds, list): inbounds = [inbounds]
-        for inbound_id in inbounds:
-            inbound_data = api.get_inbound(inbound_id)
-            if inbound_data:
-                link = get_config_from_api(inbound_data, f"{user_id}#{inbound_id}")
-                if link: all_vless_links.append(link)
+    # Newline-joined links, built in place rather than via a list + join
+    all_vless_links = bytearray()
+    for links in await run_per_panel(apis, config, provision_user, user_id, "", total_bytes, expiry_ms):
+        for link in links:
+            if all_vless_links: all_vless_links += b"\n"
+            all_vless_links += link.encode('utf-8')
 
     if not all_vless_links:
         await query.edit_message_text("Error creating subscription file. Please contact support.")
         return ConversationHandler.END
 
     subscription_id = generate_subscription_id()
-    encoded_content = base64.b64encode("\n".join(all_vless_links).encode('utf-8')).decode('utf-8')
-    sub_dir = Path(config['subscription'].get('uri', 'sub'))
-    sub_dir.mkdir(exist_ok=True)
-    (sub_dir / subscription_id).write_text(encoded_content, encoding='utf-8')
+    await asyncio.to_thread(write_subscription, config['_sub_dir'], subscription_id, base64.b64encode(all_vless_links))
 
-    users_db[user_id] = {"name": user_name, "language": lang, "subscription": subscription_id, "quota": float(defaults['total_gb'])}
-    save_yaml(users_db, USER_DB_FILE)
+    await asyncio.to_thread(save_user, user_id, {"name": user_name, "language": lang, "subscription": subscription_id, "quota": config['_default_gb']})
     
     subscription_name = config['subscription'].get('name', 'VPN') 
     sub_url = f"{config['subscription']['url']}/{subscription_id}#{quote(subscription_name)}"
@@ -662,46 +992,28 @@ async def new_get_lang(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
 async def delete_command_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if str(update.effective_user.id) != ADMIN_ID: return ConversationHandler.END
-    users_db = load_yaml(USER_DB_FILE)
-    if not users_db:
+    markup = build_user_keyboard("delete")
+    if markup is None:
         await update.message.reply_text("No users found to delete.")
         return ConversationHandler.END
-    await update.message.reply_text("Select a user to DELETE. This action is irreversible.", reply_markup=build_user_keyboard(users_db, "delete_user_"))
+    await update.message.reply_text("Select a user to DELETE. This action is irreversible.", reply_markup=markup)
     return DELETE_USER_SELECT
 
 async def delete_user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     user_id_to_delete = query.data.replace("delete_user_", "")
-    users_db = load_yaml(USER_DB_FILE)
-    user_info = users_db.get(user_id_to_delete)
+    user_info = get_user(user_id_to_delete)
     if not user_info:
         await query.edit_message_text("User not found in database.")
         return ConversationHandler.END
     await query.edit_message_text(f"Deleting user *{user_info['name']}* (`{user_id_to_delete}`)... Please wait.", parse_mode=ParseMode.MARKDOWN)
-    config_data = load_yaml(CONFIG_FILE)
-    config = config_data.get("settings", {})
-    deleted_count = 0
-    for server_name, server_config in config['db'].items():
-        api = XUIApi(server_config['address'], server_config['panel_path'], config['subscription']['user'], config['subscription']['password'])
-        if not api.logged_in: continue
-        inbounds = server_config.get('inbound', [])
-        if not isinstance(inbounds, list): inbounds = [inbounds]
-        for inbound_id in inbounds:
-            inbound_data = api.get_inbound(inbound_id)
-            if not inbound_data: continue
-            settings = json.loads(inbound_data.get("settings", "{}"))
-            client_email = f"{user_id_to_delete}#{inbound_id}"
-            client_to_delete = next((c for c in settings.get("clients", []) if c.get("email") == client_email), None)
-            if client_to_delete and 'id' in client_to_delete:
-                if api.delete_client(inbound_id, client_to_delete['id']):
-                    deleted_count += 1
-            else:
-                logger.warning(f"Client {client_email} not found in inbound {inbound_id} during deletion.")
-    subscription_id = users_db[user_id_to_delete]['subscription']
-    del users_db[user_id_to_delete]
-    save_yaml(users_db, USER_DB_FILE)
-    sub_file = Path(config['subscription'].get('uri', 'sub')) / subscription_id
+    config = load_config()
+    apis = await connect_panels(config)
+    deleted_count = sum(await run_per_panel(apis, config, delete_user_clients, user_id_to_delete))
+    subscription_id = user_info['subscription']
+    await asyncio.to_thread(delete_user, user_id_to_delete)
+    sub_file = config['_sub_dir'] / subscription_id
     if sub_file.exists(): sub_file.unlink()
     await query.edit_message_text(f"Successfully deleted user *{user_info['name']}*.\n({deleted_count} panel clients removed).", parse_mode=ParseMode.MARKDOWN)
     return ConversationHandler.END
@@ -720,7 +1032,7 @@ async def broadcast_receive_message(update: Update, context: ContextTypes.DEFAUL
     message = update.message
     await message.reply_text("Processing broadcast, please wait...")
 
-    users_db = load_yaml(USER_DB_FILE)
+    users_db = load_users()
     if not users_db:
         await message.reply_text("There are no users to broadcast to.")
         return ConversationHandler.END
@@ -770,24 +1082,45 @@ async def broadcast_receive_message(update: Update, context: ContextTypes.DEFAUL
 # MAIN FUNCTION
 # ==============================================================================
 
+async def keep_panels_logged_in() -> None:
+    """Logs into every panel at startup and renews sessions before they expire, keeping logins off the handler path."""
+    while True:
+        try:
+            config = load_config()
+            if config.get('_servers'):
+                apis = await connect_panels(config)
+                await asyncio.gather(*(api.refresh_session() for api in apis.values()))
+        except Exception as e:
+            logger.error(f"Failed to refresh panel sessions: {e}", exc_info=True)
+        await asyncio.sleep(SESSION_REFRESH_INTERVAL)
+
+_background_tasks: List[asyncio.Task] = []
+
 async def post_init(application: Application) -> None:
     await application.bot.delete_my_commands()
     logger.info("Cleared old command menu.")
+    _background_tasks.append(asyncio.create_task(keep_panels_logged_in()))
+
+async def post_shutdown(application: Application) -> None:
+    for task in _background_tasks: task.cancel()
+    await asyncio.gather(*(api.client.aclose() for api in _api_pool.values()), *_closing_clients)
 
 def main() -> None:
     if not BOT_TOKEN or not ADMIN_ID:
         logger.critical("FATAL: BOT_TOKEN or ADMIN environment variable is not set.")
         return
 
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    migrate_legacy_users()
+    application = Application.builder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
     
     conv_handlers = [
         ConversationHandler(
             entry_points=[CommandHandler("edit", edit_command_start)],
             states={
-                SELECT_USER: [CallbackQueryHandler(select_user_callback, pattern="^edit_user_")],
-                SELECT_DURATION: [CallbackQueryHandler(select_duration_callback, pattern="^edit_dur_")],
-                SELECT_QUOTA: [CallbackQueryHandler(select_quota_callback, pattern="^edit_quota_")],
+                SELECT_USER: [CallbackQueryHandler(select_user_callback, pattern="^edit_user_"),
+                              CallbackQueryHandler(user_page_callback, pattern=r"^edit_page_\d+$")],
+                SELECT_DURATION: [CallbackQueryHandler(select_duration_callback, pattern=r"^edit_dur_\d+$")],
+                SELECT_QUOTA: [CallbackQueryHandler(select_quota_callback, pattern=r"^edit_quota_\d+(\.\d+)?$")],
             }, fallbacks=[CallbackQueryHandler(cancel_callback, pattern="^cancel$")]
         ),
         ConversationHandler(
@@ -800,7 +1133,8 @@ def main() -> None:
         ),
         ConversationHandler(
             entry_points=[CommandHandler("delete", delete_command_start)],
-            states={DELETE_USER_SELECT: [CallbackQueryHandler(delete_user_callback, pattern="^delete_user_")]},
+            states={DELETE_USER_SELECT: [CallbackQueryHandler(delete_user_callback, pattern="^delete_user_"),
+                                         CallbackQueryHandler(user_page_callback, pattern=r"^delete_page_\d+$")]},
             fallbacks=[CallbackQueryHandler(cancel_callback, pattern="^cancel$")]
         ),
         ConversationHandler(
@@ -821,5 +1155,4 @@ def main() -> None:
     application.run_polling()
 
 if __name__ == "__main__":
-    requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
     main()
\ No newline at end of file
@@ -3,17 +3,38 @@ import time
 import yaml
 import base64
 import json
+import sqlite3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import uuid
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import quote, urlencode
-from typing import Optional, Dict
+from typing import Optional, Dict, Any
 from datetime import datetime, timedelta
 
+# Prefer the LibYAML-backed C loader, falling back to pure Python
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Prefer orjson for JSON (de)serialization, falling back to the stdlib
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj: Any) -> str: return orjson.dumps(obj).decode()
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+    def json_dumps(obj: Any) -> str: return json.dumps(obj, separators=(",", ":"))
+
 # --- Configuration & Constants ---
 CONFIG_FILE = Path("database.yaml")
-USER_DB_FILE = Path("users.yaml")
+USER_DB_FILE = Path("users.db")
+LEGACY_USER_DB_FILE = Path("users.yaml")
 GB_TO_BYTES = 1024**3
 DAYS_TO_MS = 24 * 60 * 60 * 1000
 
@@ -31,29 +52,40 @@ logger = logging.getLogger(__name__)
 def load_yaml(file_path: Path) -> dict:
     if not file_path.exists(): return {}
     with open(file_path, "r", encoding='utf-8') as f:
-        data = yaml.safe_load(f)
+        data = yaml.load(f, Loader=SafeLoader)
         return data if data is not None else {}
 
-def format_timedelta(delta: timedelta) -> str:
-    """Formats a timedelta object into a 'Xd Yh Zm' string."""
-    if delta.total_seconds() < 0: return "Passed"
-    days = delta.days
-    hours, remainder = divmod(delta.seconds, 3600)
-    minutes, _ = divmod(remainder, 60)
+def load_users() -> dict:
+    # The bot migrates users.yaml into users.db on startup; read the old file until then.
+    if not USER_DB_FILE.exists(): return load_yaml(LEGACY_USER_DB_FILE)
+    conn = sqlite3.connect(f"file:{USER_DB_FILE}?mode=ro", uri=True)
+    try:
+        rows = conn.execute("SELECT id, subscription, quota FROM users").fetchall()
+    finally:
+        conn.close()
+    return {user_id: {k: v for k, v in (("subscription", subscription), ("quota", quota)) if v is not None} for user_id, subscription, quota in rows}
+
+def now_ms() -> int: return time.time_ns() // 1_000_000
+
+def format_time_left(left_ms: int) -> str:
+    """Formats a duration in milliseconds into a 'Xd Yh Zm' string."""
+    if left_ms < 0: return "Passed"
+    hours, minutes = divmod(left_ms // 60_000, 60)
+    days, hours = divmod(hours, 24)
     return f"{days}d {hours}h {minutes}m"
 
-def calculate_next_reset_time(last_reset_ms: int, interval: str) -> Optional[datetime]:
-    """Calculates the next reset datetime based on the last reset time and interval."""
+def calculate_next_reset_time(last_reset_ms: int, interval: str) -> Optional[int]:
+    """Calculates the next reset time in ms based on the last reset time and interval."""
     if interval == "never" or last_reset_ms == 0:
         return None
-        
-    last_reset_dt = datetime.fromtimestamp(last_reset_ms / 1000)
     
     if interval == "daily":
-        return last_reset_dt + timedelta(days=1)
+        return last_reset_ms + DAYS_TO_MS
     elif interval == "weekly":
-        return last_reset_dt + timedelta(days=7)
+        return last_reset_ms + 7 * DAYS_TO_MS
     elif interval == "monthly":
+        # Calendar months vary in length, so this one still goes through datetime
+        last_reset_dt = datetime.fromtimestamp(last_reset_ms / 1000)
         year, month = last_reset_dt.year, last_reset_dt.month
         month += 1
         if month > 12:
@@ -61,74 +93,111 @@ def calculate_next_reset_time(last_reset_ms: int, interval: str) -> Optional[dat
             year += 1
         
         try:
-            return last_reset_dt.replace(year=year, month=month)
+            next_reset_dt = last_reset_dt.replace(year=year, month=month)
         except ValueError:
             next_month_first_day = last_reset_dt.replace(year=year, month=month, day=1)
-            return next_month_first_day - timedelta(days=1)
+            next_reset_dt = next_month_first_day - timedelta(days=1)
+        return int(next_reset_dt.timestamp() * 1000)
     return None
 
+# {email: client} indexes keyed by the raw inbound settings JSON they were built from
+_clients_index_cache: dict = {}
+
+def clients_by_email(inbound_data: dict) -> dict:
+    """Returns an inbound's clients keyed by email, parsing each distinct settings string once; don't mutate it."""
+    raw_settings = inbound_data.get("settings", "{}")
+    index = _clients_index_cache.get(raw_settings)
+    if index is None:
+        # Every added client changes the string, so drop stale entries rather than let them pile up
+        if len(_clients_index_cache) >= 64: _clients_index_cache.clear()
+        index = _clients_index_cache[raw_settings] = {c.get("email"): c for c in json_loads(raw_settings).get("clients", [])}
+    return index
+
+# (link_suffix, fragment) per inbound, keyed by the fields the link is built from
+_inbound_template_cache: dict = {}
+
+def get_inbound_template(inbound_data: dict) -> Optional[tuple]:
+    """Parses an inbound's stream settings and URL-encodes them once; a link is f"vless://{uuid}{link_suffix}{fragment}"."""
+    key = (inbound_data.get("listen"), inbound_data.get("port"), inbound_data.get("streamSettings", "{}"), inbound_data.get("remark"))
+    if key in _inbound_template_cache: return _inbound_template_cache[key]
+    stream_settings = json_loads(inbound_data.get("streamSettings", "{}"))
+    listen_ip = inbound_data.get("listen")
+    port = inbound_data.get("port")
+    server_address = listen_ip if listen_ip and listen_ip not in ["127.0.0.1", "0.0.0.0", ""] else None
+    if stream_settings.get("externalProxy"):
+        proxy = stream_settings.get("externalProxy", [{}])[0]
+        server_address = proxy.get("dest", server_address)
+        port = proxy.get("port", port)
+    if not server_address:
+        _inbound_template_cache[key] = None
+        return None
+    params = {"encryption": "none"}
+    security_type = stream_settings.get("security")
+    params["security"] = security_type if security_type != "none" else ""
+    if security_type == "reality":
+        reality_settings = stream_settings.get("realitySettings", {})
+        nested_settings = reality_settings.get("settings", {})
+        params["pbk"] = nested_settings.get("publicKey"); params["fp"] = nested_settings.get("fingerprint")
+        params["sni"] = reality_settings.get("serverNames", [""])[0]; params["sid"] = reality_settings.get("shortIds", [""])[0]
+        params["spx"] = nested_settings.get("spiderX")
+    elif security_type == "tls":
+        tls_settings = stream_settings.get("tlsSettings", {})
+        nested_settings = tls_settings.get("settings", {})
+        params["sni"] = tls_settings.get("serverName"); params["fp"] = nested_settings.get("fingerprint")
+        alpn_list = tls_settings.get("alpn", [])
+        if alpn_list: params["alpn"] = ",".join(alpn_list)
+    network_type = stream_settings.get("network")
+    params["type"] = network_type
+    if network_type == "tcp":
+        tcp_settings = stream_settings.get("tcpSettings", {})
+        if tcp_settings.get("header", {}).get("type") == "http":
+            params["headerType"] = "http"
+            path_list = tcp_settings.get("header", {}).get("request", {}).get("path", [])
+            if path_list: params["path"] = path_list[0]
+    elif network_type == "ws":
+        ws_settings = stream_settings.get("wsSettings", {})
+        params["path"] = ws_settings.get("path")
+        host = ws_settings.get("headers", {}).get("Host")
+        if host: params["host"] = host
+    elif network_type == "grpc":
+        grpc_settings = stream_settings.get("grpcSettings", {}); params["serviceName"] = grpc_settings.get("serviceName")
+    elif network_type == "http":
+        http_settings = stream_settings.get("httpSettings", {}); params["path"] = http_settings.get("path")
+        host_list = http_settings.get("host", [])
+        if host_list: params["host"] = host_list[0]
+    elif network_type == "xhttp":
+        xhttp_settings = stream_settings.get("xhttpSettings", {})
+        params["path"] = xhttp_settings.get("path"); params["mode"] = xhttp_settings.get("mode")
+        host = xhttp_settings.get("host", "")
+        if host: params["host"] = host
+    params = {k: v for k, v in params.items() if v is not None and v != ""}
+    remark = inbound_data.get('remark')
+    template = (f"@{server_address}:{port}?{urlencode(params, quote_via=quote)}#", quote(remark) if remark is not None else None)
+    _inbound_template_cache[key] = template
+    return template
+
 def get_config_from_api(inbound_data: dict, email: str) -> Optional[str]:
     try:
-        stream_settings = json.loads(inbound_data.get("streamSettings", "{}"))
-        settings = json.loads(inbound_data.get("settings", "{}"))
-        client_data = next((c for c in settings.get("clients", []) if c.get("email") == email), None)
+        client_data = clients_by_email(inbound_data).get(email)
         if not client_data: return None
-        listen_ip = inbound_data.get("listen")
-        port = inbound_data.get("port")
-        server_address = listen_ip if listen_ip and listen_ip not in ["127.0.0.1", "0.0.0.0", ""] else None
-        if stream_settings.get("externalProxy"):
-            proxy = stream_settings.get("externalProxy", [{}])[0]
-            server_address = proxy.get("dest", server_address)
-            port = proxy.get("port", port)
-        if not server_address: return None
-        params = {"encryption": "none"}
-        security_type = stream_settings.get("security")
-        params["security"] = security_type if security_type != "none" else ""
-        if security_type == "reality":
-            reality_settings = stream_settings.get("realitySettings", {})
-            nested_settings = reality_settings.get("settings", {})
-            params["pbk"] = nested_settings.get("publicKey"); params["fp"] = nested_settings.get("fingerprint")
-            params["sni"] = reality_settings.get("serverNames", [""])[0]; params["sid"] = reality_settings.get("shortIds", [""])[0]
-            params["spx"] = nested_settings.get("spiderX")
-        elif security_type == "tls":
-            tls_settings = stream_settings.get("tlsSettings", {})
-            nested_settings = tls_settings.get("settings", {})
-            params["sni"] = tls_settings.get("serverName"); params["fp"] = nested_settings.get("fingerprint")
-            alpn_list = tls_settings.get("alpn", [])
-            if alpn_list: params["alpn"] = ",".join(alpn_list)
-        network_type = stream_settings.get("network")
-        params["type"] = network_type
-        if network_type == "tcp":
-            tcp_settings = stream_settings.get("tcpSettings", {})
-            if tcp_settings.get("header", {}).get("type") == "http":
-                params["headerType"] = "http"
-                path_list = tcp_settings.get("header", {}).get("request", {}).get("path", [])
-                if path_list: params["path"] = path_list[0]
-        elif network_type == "ws":
-            ws_settings = stream_settings.get("wsSettings", {})
-            params["path"] = ws_settings.get("path")
-            host = ws_settings.get("headers", {}).get("Host")
-            if host: params["host"] = host
-        elif network_type == "grpc":
-            grpc_settings = stream_settings.get("grpcSettings", {}); params["serviceName"] = grpc_settings.get("serviceName")
-        elif network_type == "http":
-            http_settings = stream_settings.get("httpSettings", {}); params["path"] = http_settings.get("path")
-            host_list = http_settings.get("host", [])
-            if host_list: params["host"] = host_list[0]
-        elif network_type == "xhttp":
-            xhttp_settings = stream_settings.get("xhttpSettings", {})
-            params["path"] = xhttp_settings.get("path"); params["mode"] = xhttp_settings.get("mode")
-            host = xhttp_settings.get("host", "")
-            if host: params["host"] = host
-        params = {k: v for k, v in params.items() if v is not None and v != ""}
-        base_url = f"vless://{client_data['id']}@{server_address}:{port}"
-        query_string = urlencode(params, quote_via=quote)
-        config_name = inbound_data.get('remark', f"Config-{email.split('#')[0]}")
-        return f"{base_url}?{query_string}#{quote(config_name)}"
+        template = get_inbound_template(inbound_data)
+        if not template: return None
+        link_suffix, fragment = template
+        if fragment is None: fragment = quote(f"Config-{email.split('#')[0]}")
+        return f"vless://{client_data['id']}{link_suffix}{fragment}"
     except Exception as e:
         logger.error(f"Failed to reconstruct config for email {email}: {e}", exc_info=True)
         return None
 
+def write_subscription(sub_dir: Path, subscription_id: str, content: bytes) -> None:
+    """Writes a subscription file via a temp file and rename, so subs.py never serves a half-written one.
+
+    Not fsynced: every file is rewritten on the next run anyway.
+    """
+    tmp_path = sub_dir / f".{subscription_id}.{os.getpid()}.tmp"
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, sub_dir / subscription_id)
+
 # ==============================================================================
 # 3X-UI API WRAPPER CLASS (EXPANDED)
 # ==============================================================================
@@ -138,11 +207,16 @@ class XUIApi:
         self.base_url = f"{address.rstrip('/')}{panel_path}"
         self.session = requests.Session()
         self.session.headers.update({'Accept': 'application/json'})
+        self.session.verify = False
+        # Retries failed connects, and gateway errors on everything but POST (urllib3's default), as addClient isn't idempotent
+        adapter = HTTPAdapter(max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=(502, 503, 504)))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
         self.logged_in = self._login(username, password)
 
     def _login(self, username, password):
         try:
-            response = self.session.post(f"{self.base_url}login", data={'username': username, 'password': password}, verify=False)
+            response = self.session.post(f"{self.base_url}login", data={'username': username, 'password': password})
             response.raise_for_status()
             return response.json().get('success')
         except requests.exceptions.RequestException: return False
@@ -150,7 +224,7 @@ class XUIApi:
     def get_inbound(self, inbound_id: int) -> Optional[dict]:
         if not self.logged_in: return None
         try:
-            response = self.session.get(f"{self.base_url}panel/api/inbounds/get/{inbound_id}", verify=False)
+            response = self.session.get(f"{self.base_url}panel/api/inbounds/get/{inbound_id}")
             response.raise_for_status()
             data = response.json()
             return data.get('obj') if data.get('success') else None
@@ -159,8 +233,8 @@ class XUIApi:
     def add_client(self, inbound_id: int, client_settings: dict) -> bool:
         if not self.logged_in: return False
         try:
-            payload = {'id': inbound_id, 'settings': json.dumps({"clients": [client_settings]})}
-            response = self.session.post(f"{self.base_url}panel/api/inbounds/addClient", data=payload, verify=False)
+            payload = {'id': inbound_id, 'settings': json_dumps({"clients": [client_settings]})}
+            response = self.session.post(f"{self.base_url}panel/api/inbounds/addClient", data=payload)
             response.raise_for_status()
             data = response.json()
             if data.get('success'):
@@ -176,7 +250,7 @@ class XUIApi:
         if not self.logged_in: return None
         try:
             encoded_email = quote(email)
-            response = self.session.get(f"{self.base_url}panel/api/inbounds/getClientTraffics/{encoded_email}", verify=False)
+            response = self.session.get(f"{self.base_url}panel/api/inbounds/getClientTraffics/{encoded_email}")
             response.raise_for_status()
             data = response.json()
             return data.get('obj') if data.get('success') else None
@@ -188,13 +262,11 @@ class XUIApi:
 # ==============================================================================
 
 def get_or_create_client(api: XUIApi, inbound_data: Dict, client_email: str, user_quota: float, defaults: Dict) -> Optional[Dict]:
-    settings = json.loads(inbound_data.get("settings", "{}"))
-    existing_client = next((c for c in settings.get("clients", []) if c.get("email") == client_email), None)
+    existing_client = clients_by_email(inbound_data).get(client_email)
     if existing_client: return existing_client
 
     logger.info(f"Client '{client_email}' not found in inbound {inbound_data['id']}. Creating now...")
-    now_ms = int(time.time() * 1000)
-    expiry_ms = now_ms + (int(defaults['duration_days']) * DAYS_TO_MS)
+    expiry_ms = now_ms() + (int(defaults['duration_days']) * DAYS_TO_MS)
     total_bytes = int(user_quota * GB_TO_BYTES)
 
     new_client_payload = {
@@ -209,79 +281,91 @@ def get_or_create_client(api: XUIApi, inbound_data: Dict, client_email: str, use
         logger.error(f"Failed to create client '{client_email}' on inbound {inbound_data['id']}.")
         return None
 
+def sync_user_on_server(api: XUIApi, inbound_ids: list, user_id: str, user_quota: float, defaults: Dict) -> tuple:
+    """Reads a user's traffic from one panel and makes sure they have a client on each of its inbounds.
+
+    Returns (used_bytes, expiry_time, next_reset_time, links) for that panel.
+    """
+    used_bytes, expiry_time, next_reset_time = 0, 0, None
+    for inbound_id in inbound_ids:
+        traffic_data = api.get_client_traffics(f"{user_id}#{inbound_id}")
+        if traffic_data:
+            # --- FIX: Sum both UP and DOWN traffic ---
+            used_bytes += traffic_data.get('up', 0) + traffic_data.get('down', 0)
+            if expiry_time == 0: expiry_time = traffic_data.get('expiryTime', 0)
+        
+        inbound_details = api.get_inbound(inbound_id)
+        if inbound_details:
+            next_reset = calculate_next_reset_time(inbound_details.get('lastTrafficResetTime', 0), inbound_details.get('trafficReset', 'never'))
+            if next_reset and (next_reset_time is None or next_reset < next_reset_time):
+                next_reset_time = next_reset
+
+    links = []
+    for inbound_id in inbound_ids:
+        inbound_data = api.get_inbound(inbound_id)
+        if not inbound_data: continue
+        client_email = f"{user_id}#{inbound_id}"
+        
+        client_info = get_or_create_client(api, inbound_data, client_email, user_quota, defaults)
+        
+        if client_info:
+            fresh_inbound_data = api.get_inbound(inbound_id)
+            if fresh_inbound_data:
+                link = get_config_from_api(fresh_inbound_data, client_email)
+                if link: links.append(link)
+    return used_bytes, expiry_time, next_reset_time, links
+
 def sync_all_subscriptions(config: dict, users_db: dict):
     logger.info("Task: Synchronizing all user subscriptions...")
     count = 0
     sub_dir_path = Path(config['subscription'].get('uri', 'sub'))
-    sub_dir_path.mkdir(exist_ok=True)
-    defaults = {k.strip(): v.strip() for k, v in (item.split('=') for item in config['default'])}
-
-    apis = {s_name: XUIApi(s_conf['address'], s_conf['panel_path'], config['subscription']['user'], config['subscription']['password']) for s_name, s_conf in config['db'].items()}
-
-    for user_id, user_data in users_db.items():
-        subscription_id = user_data.get("subscription")
-        if not subscription_id: continue
-
-        total_used_bytes, master_expiry_time = 0, 0
-        user_total_gb = user_data.get('quota', float(defaults['total_gb']))
-        next_reset_time_to_display = None
+    sub_dir_path.mkdir(parents=True, exist_ok=True)
+    defaults = {k.strip(): v.strip() for k, v in (item.split('=', 1) for item in config['default'])}
+    default_total_gb = float(defaults['total_gb'])
 
+    # One worker per panel: each user's panels are synced concurrently, each panel's calls stay sequential
+    with ThreadPoolExecutor(max_workers=max(1, len(config['db']))) as executor:
+        logins = executor.map(lambda s_conf: XUIApi(s_conf['address'], s_conf['panel_path'], config['subscription']['user'], config['subscription']['password']), config['db'].values())
+        apis = dict(zip(config['db'], logins))
+        servers = []
         for server_name, server_config in config['db'].items():
             api = apis.get(server_name)
             if not (api and api.logged_in): continue
             inbounds = server_config.get('inbound', [])
-            if not isinstance(inbounds, list): inbounds = [inbounds]
-            for inbound_id in inbounds:
-                traffic_data = api.get_client_traffics(f"{user_id}#{inbound_id}")
-                if traffic_data:
-                    # --- FIX: Sum both UP and DOWN traffic ---
-                    total_used_bytes += traffic_data.get('up', 0) + traffic_data.get('down', 0)
-                    if master_expiry_time == 0: master_expiry_time = traffic_data.get('expiryTime', 0)
-                
-                inbound_details = api.get_inbound(inbound_id)
-                if inbound_details:
-                    next_reset = calculate_next_reset_time(inbound_details.get('lastTrafficResetTime', 0), inbound_details.get('trafficReset', 'never'))
-                    if next_reset and (next_reset_time_to_display is None or next_reset < next_reset_time_to_display):
-                        next_reset_time_to_display = next_reset
+            servers.append((api, inbounds if isinstance(inbounds, list) else [inbounds]))
+
+        for user_id, user_data in users_db.items():
+            subscription_id = user_data.get("subscription")
+            if not subscription_id: continue
+
+            total_used_bytes, master_expiry_time = 0, 0
+            user_total_gb = user_data.get('quota', default_total_gb)
+            next_reset_time_to_display = None
+            server_links = []
+
+            for used_bytes, expiry_time, next_reset, links in executor.map(lambda server: sync_user_on_server(*server, user_id, user_total_gb, defaults), servers):
+                total_used_bytes += used_bytes
+                if master_expiry_time == 0: master_expiry_time = expiry_time
+                if next_reset and (next_reset_time_to_display is None or next_reset < next_reset_time_to_display):
+                    next_reset_time_to_display = next_reset
+                server_links.extend(links)
         
-        used_gb = total_used_bytes / GB_TO_BYTES
-        remaining_gb = max(0, user_total_gb - used_gb)
+            used_gb = total_used_bytes / GB_TO_BYTES
+            remaining_gb = max(0, user_total_gb - used_gb)
         
-        expiry_delta = timedelta(milliseconds=(master_expiry_time - (time.time() * 1000))) if master_expiry_time > 0 else timedelta(days=9999)
-        time_left_str = format_timedelta(expiry_delta)
+            left_ms = master_expiry_time - now_ms() if master_expiry_time > 0 else 9999 * DAYS_TO_MS
+            time_left_str = format_time_left(left_ms)
         
-        dummy_name = f"🌐 {remaining_gb:.2f}/{user_total_gb:.2f} GB"
-        if next_reset_time_to_display:
-            reset_delta = next_reset_time_to_display - datetime.now()
-            dummy_name += f" 🔁 {format_timedelta(reset_delta)}"
-        dummy_name += f" ⏳ {time_left_str}"
+            dummy_name = f"🌐 {remaining_gb:.2f}/{user_total_gb:.2f} GB"
+            if next_reset_time_to_display:
+                dummy_name += f" 🔁 {format_time_left(next_reset_time_to_display - now_ms())}"
+            dummy_name += f" ⏳ {time_left_str}"
 
-        dummy_link = f"vless://00000000-0000-0000-0000-000000000000@1.1.1.1:1?type=ws#{quote(dummy_name)}"
-        all_vless_links_for_user = [dummy_link]
+            dummy_link = f"vless://00000000-0000-0000-0000-000000000000@1.1.1.1:1?type=ws#{quote(dummy_name)}"
+            all_vless_links_for_user = [dummy_link] + server_links
 
-        for server_name, server_config in config['db'].items():
-            api = apis.get(server_name)
-            if not (api and api.logged_in): continue
-            inbounds = server_config.get('inbound', [])
-            if not isinstance(inbounds, list): inbounds = [inbounds]
-            for inbound_id in inbounds:
-                inbound_data = api.get_inbound(inbound_id)
-                if not inbound_data: continue
-                client_email = f"{user_id}#{inbound_id}"
-                
-                client_info = get_or_create_client(api, inbound_data, client_email, user_total_gb, defaults)
-                
-                if client_info:
-                    fresh_inbound_data = api.get_inbound(inbound_id)
-                    if fresh_inbound_data:
-                        link = get_config_from_api(fresh_inbound_data, client_email)
-                        if link: all_vless_links_for_user.append(link)
-
-        subscription_file_path = sub_dir_path / subscription_id
-        combined_links = "\n".join(all_vless_links_for_user)
-        encoded_content = base64.b64encode(combined_links.encode('utf-8')).decode('utf-8')
-        subscription_file_path.write_text(encoded_content, encoding='utf-8')
-        if len(all_vless_links_for_user) > 1: count += 1
+            write_subscription(sub_dir_path, subscription_id, base64.b64encode("\n".join(all_vless_links_for_user).encode('utf-8')))
+            if len(all_vless_links_for_user) > 1: count += 1
 
     logger.info(f"Finished synchronizing {count} subscription files.")
 
@@ -299,7 +383,7 @@ def main():
             print("-" * 50)
             logger.info("Starting sync run...")
             config = load_yaml(CONFIG_FILE).get("settings", {})
-            users_db = load_yaml(USER_DB_FILE)
+            users_db = load_users()
             if not config or 'db' not in config or not users_db:
                 logger.warning("Config ('settings' or 'db' section) or users file is empty or invalid. Skipping run.")
             else: